@@ -1,7 +1,6 @@
 from itertools import chain
 import gc
-import glob
-import codecs
+import os
 import math
 from collections import defaultdict
 
@@ -25,7 +24,7 @@ torchtext.vocab.Vocab.__setstate__ = _setstate
 
 
 def make_text_iterator_from_file(path):
-    with codecs.open(path, "r", "utf-8") as corpus_file:
+    with open(path, "r", encoding="utf-8", buffering=1024 * 1024) as corpus_file:
         for line in corpus_file:
             yield line  # 每次遇到yield关键字后返回相应结果，并保留函数当前的运行状态，等待下一次的调用
 
@@ -265,8 +264,11 @@ def load_dataset(corpus_type, opt):
                     (corpus_type, pt_file, len(dataset)))
         return dataset
 
-    # Sort the glob output by file name (by increasing indexes).
-    pts = sorted(glob.glob(opt.data + '_' + corpus_type + '.[0-9]*.pt'))
+    # Shards are numbered from 0 without gaps, so derive their names in index
+    # order instead of sorting a glob (which puts `.10.pt` before `.2.pt`).
+    pts = []
+    while os.path.exists('{:s}_{:s}.{:d}.pt'.format(opt.data, corpus_type, len(pts))):
+        pts.append('{:s}_{:s}.{:d}.pt'.format(opt.data, corpus_type, len(pts)))
     if pts:
         for pt in pts:
             yield _dataset_loader(pt, corpus_type)
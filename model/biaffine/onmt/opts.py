@@ -106,6 +106,8 @@ def preprocess_opts(parser):
                      shard_size=0 means no segmentation
                      shard_size>0 means segment dataset into multiple shards,
                      each shard has shard_size samples""")
+    group.add('--num_workers', '-num_workers', type=int, default=1,
+              help="Number of processes used to build the shards in parallel")
 
     # Dictionary options, for text corpus
 
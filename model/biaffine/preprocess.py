@@ -1,14 +1,16 @@
 import configargparse
-import glob
-import os
-import codecs
+import contextlib
 import gc
+import mmap
+import os
+import pickle
+import stat
 
 import torch
-import torchtext.vocab
-from collections import Counter, OrderedDict
+from collections import Counter
+from itertools import chain, islice, zip_longest
+from multiprocessing import Process, get_context
 
-import onmt.constants as Constants
 import onmt.opts as opts
 from inputters.dataset import get_fields, build_dataset, make_text_iterator_from_file
 from utils.logging import init_logger, logger
@@ -29,68 +31,78 @@ def save_fields_to_vocab(fields):
 
 def build_field_vocab(field, counter, **kwargs):  # *args表示任何多个无名参数，它是一个tuple；**kwargs表示关键字参数，它是一个 dict
     # fromkey()指定一个列表，把列表中的值作为字典的key,生成一个字典
-    specials = list(OrderedDict.fromkeys(
-        tok for tok in [field.unk_token, field.pad_token, field.init_token, field.eos_token]
+    specials = list(dict.fromkeys(
+        tok for tok in (field.unk_token, field.pad_token, field.init_token, field.eos_token)
         if tok is not None))
     field.vocab = field.vocab_cls(counter, specials=specials, **kwargs)
 
 
-def merge_vocabs(vocabs, vocab_size=None, min_frequency=1):
-    merged = sum([vocab.freqs for vocab in vocabs], Counter())
-    return torchtext.vocab.Vocab(merged,
-                                 specials=[Constants.UNK_WORD, Constants.PAD_WORD,
-                                           Constants.BOS_WORD, Constants.EOS_WORD],
-                                 max_size=vocab_size,
-                                 min_freq=min_frequency)
+def new_counter(fields):
+    """
+    Create an empty Counter for every field whose vocabulary is counted
+    from the data. `mask` is left out, its vocabulary is fixed.
+    """
+    return {k: Counter() for k in fields if k != 'mask'}
 
 
-def build_vocab(train_dataset_files, fields, share_vocab,
+def update_counter(counter, dataset, fields):
+    """
+    Count the tokens of every sequential field in `counter` from `dataset`.
+    """
+    # Collect the token sequences first and feed each counter once, so that
+    # counting runs in Counter's C loop instead of one update() per example.
+    # The sequential fields are picked once, not for every example.
+    seq_fields = [k for k in counter if fields[k].sequential]  # k: src、tgt、structure字段
+    tokens = {k: [] for k in seq_fields}
+    appends = [(k, tokens[k].append) for k in seq_fields]
+    for ex in dataset.examples:
+        for k, append in appends:
+            append(getattr(ex, k, None))
+
+    for k, vals in tokens.items():
+        vals = chain.from_iterable(vals)
+        if k == 'structure':
+            # Structure examples are tuples of rows, flatten them once more
+            # here rather than per example.
+            vals = chain.from_iterable(vals)
+        counter[k].update(vals)
+
+
+def build_vocab(counter, fields, share_vocab,
                 src_vocab_size, src_words_min_frequency,
                 tgt_vocab_size, tgt_words_min_frequency,
                 structure_vocab_size, structure_words_min_frequency, relation_vocab_size):
-    counter = {}
-
-    for k in fields:
-        counter[k] = Counter()
-
-    # Load vocabulary
-    for _, path in enumerate(train_dataset_files):
-        dataset = torch.load(path)
-        logger.info(" * reloading %s." % path)
-        for ex in dataset.examples:
-            for k in fields:  # k: src、tgt、structure字段
-                val = getattr(ex, k, None)
-                if not fields[k].sequential:
-                    continue
-                if k == 'structure' or k=='mask':
-                    for i in val:
-                        counter[k].update(i)
-                else:
-                    counter[k].update(val)
-
-        dataset.examples = None
-        gc.collect()
-        del dataset.examples
-        gc.collect()
-        del dataset
-        gc.collect()
-
-    build_field_vocab(fields["tgt"], counter["tgt"],
-                      max_size=tgt_vocab_size,
-                      min_freq=tgt_words_min_frequency)
-    logger.info(" * tgt vocab size: %d." % len(fields["tgt"].vocab))
-
-    build_field_vocab(fields["src"], counter["src"],
-                      max_size=src_vocab_size,
-                      min_freq=src_words_min_frequency)
-    logger.info(" * src vocab size: %d." % len(fields["src"].vocab))
+    if share_vocab:
+        # `tgt_vocab_size` is ignored when sharing vocabularies
+        # Build the shared vocabulary once from the merged counts instead of
+        # building src and tgt separately and merging them afterwards.
+        logger.info(" * merging src and tgt vocab...")
+        build_field_vocab(fields["tgt"], counter["src"] + counter["tgt"],
+                          max_size=src_vocab_size,
+                          min_freq=src_words_min_frequency)
+        fields["src"].vocab = fields["tgt"].vocab
+        logger.info(" * src vocab size: %d." % len(fields["src"].vocab))
+        logger.info(" * tgt vocab size: %d." % len(fields["tgt"].vocab))
+    else:
+        build_field_vocab(fields["tgt"], counter["tgt"],
+                          max_size=tgt_vocab_size,
+                          min_freq=tgt_words_min_frequency)
+        logger.info(" * tgt vocab size: %d." % len(fields["tgt"].vocab))
+
+        build_field_vocab(fields["src"], counter["src"],
+                          max_size=src_vocab_size,
+                          min_freq=src_words_min_frequency)
+        logger.info(" * src vocab size: %d." % len(fields["src"].vocab))
 
     build_field_vocab(fields["structure"], counter["structure"],
                       max_size=structure_vocab_size,
                       min_freq=structure_words_min_frequency)
     logger.info(" * structure vocab size: %d." % len(fields["structure"].vocab))
 
-    build_field_vocab(fields["mask"], counter["mask"],
+    # The mask only holds 0/1 alignment flags, so its vocabulary is known
+    # without counting. '0' is ranked first to keep itos as
+    # [<unk>, <blank>, '0', '1'], which the trainer relies on (mask - 2).
+    build_field_vocab(fields["mask"], Counter({'0': 2, '1': 1}),
                       max_size=2,
                       min_freq=0)
     logger.info(" * mask vocab size: %d." % len(fields["mask"].vocab))
@@ -100,19 +112,6 @@ def build_vocab(train_dataset_files, fields, share_vocab,
                       min_freq=0)
     logger.info(" * relation vocab size: %d." % len(fields["relation"].vocab))
 
-    # Merge the input and output vocabularies.
-    if share_vocab:
-        # `tgt_vocab_size` is ignored when sharing vocabularies
-        logger.info(" * merging src and tgt vocab...")
-        merged_vocab = merge_vocabs(
-            [fields["src"].vocab, fields["tgt"].vocab],
-            vocab_size=src_vocab_size,
-            min_frequency=src_words_min_frequency)
-        fields["src"].vocab = merged_vocab
-        fields["tgt"].vocab = merged_vocab
-        logger.info(" * src vocab size: %d." % len(fields["src"].vocab))
-        logger.info(" * tgt vocab size: %d." % len(fields["tgt"].vocab))
-
     return fields
 
 
@@ -131,138 +130,177 @@ def parse_args():
     return opt
 
 
-def build_save_in_shards_using_shards_size(src_corpus, tgt_corpus, structure_corpus, mask_corpus, relation_corpus, fields, corpus_type, opt):
-    src_data = []
-    tgt_data = []
-    structure_data = []
-    mask_data = []
-    relation_data=[]
-    with open(src_corpus, "r") as src_file:
-        with open(tgt_corpus, "r") as tgt_file:
-            with open(structure_corpus, "r") as structure_file:
-                with open(mask_corpus, 'r') as mask_file:
-                    with open(relation_corpus, 'r')as relation_file:
-                        for s, t, structure, mask, relation in zip(src_file, tgt_file, structure_file, mask_file, relation_file):
-                            src_data.append(s)
-                            tgt_data.append(t)
-                            structure_data.append(structure)
-                            mask_data.append(mask)
-                            relation_data.append(relation)
-
-                            assert (len(s.split()) + 1) ** 2 == len(structure.split()) and (len(t.split()) ** 2 == len(mask.split()))
-
-    if len(src_data) != len(tgt_data) or len(tgt_data) != len(structure_data):
-        raise AssertionError("Source,Target and structure should have the same length")
-
-    num_shards = int(len(src_data) / opt.shard_size)
-    for x in range(num_shards):
-        logger.info("Splitting shard %d." % x)
-
-        f = codecs.open(src_corpus + ".{0}.txt".format(x), "w", encoding="utf-8")
-        f.writelines(src_data[x * opt.shard_size: (x + 1) * opt.shard_size])
-        f.close()
-
-        f = codecs.open(tgt_corpus + ".{0}.txt".format(x), "w", encoding="utf-8")
-        f.writelines(tgt_data[x * opt.shard_size: (x + 1) * opt.shard_size])
-        f.close()
-
-        f = codecs.open(structure_corpus + ".{0}.txt".format(x), "w", encoding="utf-8")
-        f.writelines(structure_data[x * opt.shard_size: (x + 1) * opt.shard_size])
-        f.close()
-
-        f = codecs.open(mask_corpus + ".{0}.txt".format(x), "w", encoding="utf-8")
-        f.writelines(mask_data[x * opt.shard_size: (x + 1) * opt.shard_size])
-        f.close()
-
-        f = codecs.open(relation_corpus + ".{0}.txt".format(x), "w", encoding="utf-8")
-        f.writelines(relation_data[x * opt.shard_size: (x + 1) * opt.shard_size])
-        f.close()
-
-    num_written = num_shards * opt.shard_size
-    if len(src_data) > num_written:  # 处理最后一个剩下的shard
-        logger.info("Splitting shard %d." % num_shards)
-        f = codecs.open(src_corpus + ".{0}.txt".format(num_shards), 'w', encoding="utf-8")
-        f.writelines(src_data[num_shards * opt.shard_size:])
-        f.close()
-
-        f = codecs.open(tgt_corpus + ".{0}.txt".format(num_shards), 'w', encoding="utf-8")
-        f.writelines(tgt_data[num_shards * opt.shard_size:])
-        f.close()
-
-        f = codecs.open(structure_corpus + ".{0}.txt".format(num_shards), 'w', encoding="utf-8")
-        f.writelines(structure_data[num_shards * opt.shard_size:])
-        f.close()
-
-        f = codecs.open(mask_corpus + ".{0}.txt".format(num_shards), 'w', encoding="utf-8")
-        f.writelines(mask_data[num_shards * opt.shard_size:])
-        f.close()
-
-        f = codecs.open(relation_corpus + ".{0}.txt".format(num_shards), "w", encoding="utf-8")
-        f.writelines(relation_data[num_shards * opt.shard_size:])
-        f.close()
-
-    src_list = sorted(glob.glob(src_corpus + '.*.txt'))
-    tgt_list = sorted(glob.glob(tgt_corpus + '.*.txt'))
-    structure_list = sorted(glob.glob(structure_corpus + '.*.txt'))
-    mask_list = sorted(glob.glob(mask_corpus + '.*.txt'))
-    relation_list = sorted(glob.glob(relation_corpus + '.*.txt'))
+def count_tokens(line):
+    """
+    Count the tokens of a single-space separated raw corpus line without
+    splitting it into a list.
+    """
+    line = line.strip()
+    return line.count(b' ') + 1 if line else 0
 
-    ret_list = []
 
-    for index, src in enumerate(src_list):
-        logger.info("Building shard %d." % index)
-        src_iter = make_text_iterator_from_file(src)  # 迭代器，每次返回文件中的一行数据
-        tgt_iter = make_text_iterator_from_file(tgt_list[index])
-        structure_iter = make_text_iterator_from_file(structure_list[index])
-        mask_iter = make_text_iterator_from_file(mask_list[index])
-        relation_iter=make_text_iterator_from_file(relation_list[index])
-
-        dataset = build_dataset(
-            fields,
-            src_iter,
-            tgt_iter,
-            structure_iter,
-            mask_iter,
-            relation_iter,
-            src_seq_length=opt.src_seq_length,
-            tgt_seq_length=opt.tgt_seq_length,
-            src_seq_length_trunc=opt.src_seq_length_trunc,
-            tgt_seq_length_trunc=opt.tgt_seq_length_trunc
-        )
-
-        pt_file = "{:s}_{:s}.{:d}.pt".format(opt.save_data, corpus_type, index)  # ..../gq_coupus_type.{0,1}.pt
-
-        # We save fields in vocab.pt seperately, so make it empty.
-        dataset.fields = []
-
-        logger.info(" * saving %sth %s data shard to %s." % (index, corpus_type, pt_file))
-        torch.save(dataset, pt_file)
+def iter_lines(corpus_file):
+    """
+    Yield the raw byte lines of `corpus_file`, from a read-only memory map
+    for non-empty regular files and line by line for anything else
+    (empty files, pipes, process substitution), which can't be mapped.
+    """
+    st = os.fstat(corpus_file.fileno())
+    if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+        yield from corpus_file
+        return
+    with mmap.mmap(corpus_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        yield from iter(mm.readline, b'')
+
+
+def read_shards(corpora, shard_size):
+    """
+    Stream the aligned lines of `corpora` and yield them shard by shard,
+    as one list of lines per corpus with at most `shard_size` lines each.
+    Lines are kept as undecoded bytes, they are decoded in process_shard.
+    """
+    buffers = [[] for _ in corpora]
+    with contextlib.ExitStack() as stack:
+        corpus_files = [stack.enter_context(open(corpus, "rb")) for corpus in corpora]
+        corpus_lines = [stack.enter_context(contextlib.closing(iter_lines(f))) for f in corpus_files]
+        for lines in zip_longest(*corpus_lines):
+            if None in lines:
+                raise AssertionError("Source, target, structure, mask and relation should have the same length")
+            s, t, structure, mask, _ = lines
+            assert (count_tokens(s) + 1) ** 2 == count_tokens(structure) and count_tokens(t) ** 2 == count_tokens(mask)
+
+            for buffer, line in zip(buffers, lines):
+                buffer.append(line)
+            if len(buffers[0]) == shard_size:
+                yield buffers
+                buffers = [[] for _ in corpora]
+
+    if buffers[0]:  # 处理最后一个剩下的shard
+        yield buffers
+
+
+# (fields, corpus_type, opt) of the shards being built, set by init_shard_worker.
+shard_context = None
+
+
+def init_shard_worker(fields, corpus_type, opt):
+    """
+    Store the arguments shared by all shards in `shard_context`. Used as the
+    Pool initializer, so the fields (whose default tokenizer is a lambda and
+    can't be pickled) are inherited by the forked workers instead of being
+    sent with every shard.
+    """
+    global shard_context
+    shard_context = (fields, corpus_type, opt)
+
+
+def process_shard(args):
+    """
+    Build the dataset of one in-memory shard, save it to a `.pt` file and
+    return its path together with the token counts of the shard.
+    """
+    index, (src, tgt, structure, mask, relation) = args
+    fields, corpus_type, opt = shard_context
+
+    logger.info("Building shard %d." % index)
+    dataset = build_dataset(
+        fields,
+        (line.decode("utf-8") for line in src),
+        (line.decode("utf-8") for line in tgt),
+        (line.decode("utf-8") for line in structure),
+        (line.decode("utf-8") for line in mask),
+        (line.decode("utf-8") for line in relation),
+        src_seq_length=opt.src_seq_length,
+        tgt_seq_length=opt.tgt_seq_length,
+        src_seq_length_trunc=opt.src_seq_length_trunc,
+        tgt_seq_length_trunc=opt.tgt_seq_length_trunc
+    )
+
+    pt_file = "{:s}_{:s}.{:d}.pt".format(opt.save_data, corpus_type, index)  # ..../gq_coupus_type.{0,1}.pt
+
+    counter = None
+    if corpus_type == 'train':
+        counter = new_counter(fields)
+        update_counter(counter, dataset, fields)
+
+    # We save fields in vocab.pt seperately, so make it empty.
+    dataset.fields = []
+
+    # The shards only hold Python objects, so pickle them with the fastest
+    # protocol available; vocab.pt keeps the default for compatibility.
+    logger.info(" * saving %sth %s data shard to %s." % (index, corpus_type, pt_file))
+    torch.save(dataset, pt_file, pickle_protocol=pickle.HIGHEST_PROTOCOL)
+
+    # `dataset` is released by refcounting when this frame returns.
+    return pt_file, counter
+
+
+def remove_stale_shards(save_data, corpus_type, num_shards):
+    """
+    Remove `.pt` shards numbered from `num_shards` on, left over by an
+    earlier run with more shards, so that training only loads the shards
+    written by this run.
+    """
+    index = num_shards
+    pt_file = "{:s}_{:s}.{:d}.pt".format(save_data, corpus_type, index)
+    while os.path.exists(pt_file):
+        logger.info(" * removing stale %s data shard %s." % (corpus_type, pt_file))
+        os.remove(pt_file)
+        index += 1
+        pt_file = "{:s}_{:s}.{:d}.pt".format(save_data, corpus_type, index)
+
+
+def merge_shard_results(results, ret_list, counter):
+    """
+    Append the `.pt` files of `results` to `ret_list` and add their shard
+    counts to `counter` (None for valid).
+    """
+    for pt_file, shard_counter in results:
         ret_list.append(pt_file)
+        if counter is not None:
+            for k in counter:
+                counter[k].update(shard_counter[k])
+
+
+def build_save_in_shards_using_shards_size(src_corpus, tgt_corpus, structure_corpus, mask_corpus, relation_corpus, fields, corpus_type, opt):
+    # Tokens of the training shards are counted while they are built, so the
+    # vocabulary does not need to reload every shard from disk.
+    counter = new_counter(fields) if corpus_type == 'train' else None
+    corpora = [src_corpus, tgt_corpus, structure_corpus, mask_corpus, relation_corpus]
+
+    # Shards are handed to build_dataset straight from memory, without a
+    # round trip through temporary `.txt` shard files.
+    shard_args = enumerate(read_shards(corpora, opt.shard_size))
+
+    # Shards are independent of each other, so build them in parallel.
+    # The pool is fed num_workers shards at a time to bound memory, and the
+    # counts of each batch are merged before the next one is built.
+    ret_list = []
+    if opt.num_workers > 1:
+        # Workers are forked so that they inherit the unpicklable fields.
+        with get_context('fork').Pool(opt.num_workers, initializer=init_shard_worker,
+                                      initargs=(fields, corpus_type, opt)) as p:
+            for batch in iter(lambda: list(islice(shard_args, opt.num_workers)), []):
+                merge_shard_results(p.map(process_shard, batch), ret_list, counter)
+    else:
+        init_shard_worker(fields, corpus_type, opt)
+        merge_shard_results(map(process_shard, shard_args), ret_list, counter)
+    gc.collect()
 
-        os.remove(src)
-        os.remove(tgt_list[index])
-        os.remove(structure_list[index])
-        os.remove(mask_list[index])
-        os.remove(relation_list[index])
-        del dataset.examples
-        gc.collect()
-        del dataset
-        gc.collect()
+    remove_stale_shards(opt.save_data, corpus_type, len(ret_list))
 
-    return ret_list  # 返回一个文件名列表
+    return ret_list, counter  # 返回一个文件名列表和train集的词频
 
 
 def store_vocab_to_file(vocab, filename):
     with open(filename, "w") as f:
-        for i, token in enumerate(vocab.itos):
-            # TEXT.vocab类的三个variables,freqs 用来返回每一个单词和其对应的频数  itos 按照下标的顺序返回每一个单词 stoi 返回每一个单词与其对应的下标
-            f.write(str(i) + ' ' + token + '\n')
-        f.close()
+        # TEXT.vocab类的三个variables,freqs 用来返回每一个单词和其对应的频数  itos 按照下标的顺序返回每一个单词 stoi 返回每一个单词与其对应的下标
+        f.write(''.join('{:d} {:s}\n'.format(i, token) for i, token in enumerate(vocab.itos)))
 
 
-def build_save_vocab(train_dataset, fields, opt):
+def build_save_vocab(counter, fields, opt):
     """ Building and saving the vocab """
-    fields = build_vocab(train_dataset,
+    fields = build_vocab(counter,
                          fields,
                          opt.share_vocab,
                          opt.src_vocab_size,
@@ -283,7 +321,7 @@ def build_save_vocab(train_dataset, fields, opt):
 
 
 def build_save_dataset(corpus_type, fields, opt):  # corpus_type: train or valid
-    """ Building and saving the dataset """
+    """ Building and saving the dataset, returns the `.pt` files and the train counters (None for valid) """
     assert corpus_type in ['train', 'valid']  # Judging whether it is train or valid
 
     if corpus_type == 'train':
@@ -300,8 +338,8 @@ def build_save_dataset(corpus_type, fields, opt):  # corpus_type: train or valid
         relation_corpus = opt.valid_relation
 
     if (opt.shard_size > 0):
-        return build_save_in_shards_using_shards_size(src_corpus, tgt_corpus, structure_corpus, mask_corpus, relation_corpus, fields, corpus_type,
-                                                      opt)
+        return build_save_in_shards_using_shards_size(src_corpus, tgt_corpus, structure_corpus, mask_corpus,
+                                                      relation_corpus, fields, corpus_type, opt)
 
     # We only build a monolithic dataset.
     # But since the interfaces are uniform, it would be not hard to do this should users need this feature.
@@ -323,15 +361,33 @@ def build_save_dataset(corpus_type, fields, opt):  # corpus_type: train or valid
         src_seq_length_trunc=opt.src_seq_length_trunc,
         tgt_seq_length_trunc=opt.tgt_seq_length_trunc)
 
+    counter = None
+    if corpus_type == 'train':
+        counter = new_counter(fields)
+        update_counter(counter, dataset, fields)
+
     # We save fields in vocab.pt seperately, so make it empty.
     dataset.fields = []
 
     pt_file = "{:s}_{:s}.pt".format(opt.save_data, corpus_type)
     logger.info(" * saving %s dataset to %s." % (corpus_type, pt_file))
 
-    torch.save(dataset, pt_file)
+    torch.save(dataset, pt_file, pickle_protocol=pickle.HIGHEST_PROTOCOL)
+
+    # load_dataset prefers `.N.pt` shards, so drop any left by an earlier sharded run.
+    remove_stale_shards(opt.save_data, corpus_type, 0)
 
-    return [pt_file]
+    return [pt_file], counter  # 返回一个文件名列表和train集的词频
+
+
+def build_save_valid_dataset(opt):
+    """
+    Building and saving the validation dataset in a child process. The
+    fields are rebuilt here rather than passed in, since they can't be
+    pickled under the spawn/forkserver start methods.
+    """
+    init_logger(opt.log_file)
+    build_save_dataset('valid', get_fields(), opt)
 
 
 def main():
@@ -346,14 +402,21 @@ def main():
     logger.info("Building 'Fields' object...")
     fields = get_fields()
 
-    logger.info("Building & saving training data...")
-    train_dataset_files = build_save_dataset('train', fields, opt)  # 返回生成的文件列表
-
+    # The validation data does not depend on the training data, so build it
+    # in a separate process while the training data and vocabulary are built.
     logger.info("Building & saving validation data...")
-    build_save_dataset('valid', fields, opt)
+    valid_proc = Process(target=build_save_valid_dataset, args=(opt,))
+    valid_proc.start()
+
+    logger.info("Building & saving training data...")
+    _, counter = build_save_dataset('train', fields, opt)  # 返回生成的文件列表和词频
 
     logger.info("Building & saving vocabulary...")
-    build_save_vocab(train_dataset_files, fields, opt)  # only用train集创建vocabulary
+    build_save_vocab(counter, fields, opt)  # only用train集创建vocabulary
+
+    valid_proc.join()
+    if valid_proc.exitcode != 0:
+        raise RuntimeError("Building validation data failed with exit code %d." % valid_proc.exitcode)
 
 
 if __name__ == "__main__":